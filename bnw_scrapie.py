@@ -12,24 +12,32 @@ bnw_bar_scraper_incremental.py
                l_time,   l_pct,   l_class_pct,   l_state_pct,
                med_ft,   med_pct, med_class_pct, med_state_pct,
     profile_url, timestamp
-• Jitter delay 2-10 s, cool-down 120 s every 40 OK rows
-• Immediate append to bnw_bar_raw.csv (flushed)
-• Skips duplicates across runs by (name, test_year)
+• POOL concurrent pages, global rate limit RATE_LIMIT fetches / RATE_PERIOD s
+• Buffered append to gzip-compressed bnw_bar_raw.csv.gz through one
+  csv.DictWriter
+• Skips duplicates across runs by (name, test_year), tracked in a
+  bnw_bar_raw.seen sidecar so restarts never re-read the full CSV
 • Recomputes bnw_bar_percentiles.csv at the end
 """
-import asyncio, random, re, time, os, numpy as np, pandas as pd
+import asyncio, csv, gzip, re, sys, time, numpy as np, pandas as pd, xxhash
 from datetime import datetime
 from urllib.parse import urlparse
 from pathlib import Path
-from playwright.async_api import async_playwright, TimeoutError as PwTimeout
-from bs4 import BeautifulSoup
+from playwright.async_api import async_playwright, Error as PwError, \
+                                 TimeoutError as PwTimeout
+from asyncio_throttle import Throttler
+from bs4 import BeautifulSoup, SoupStrainer
 
 # ─── CONFIG ───────────────────────────────────────────────────────────────
 BASE, YEARS = "https://baseballnorthwest.com", ["2027"]
-WAIT_MIN, WAIT_MAX        = 2, 10         # per-profile jitter
-BURST_SIZE, BURST_PAUSE   = 40, 120       # cool-down after 40 rows
+POOL                      = 6             # concurrent pages
+RATE_LIMIT, RATE_PERIOD   = 12, 60       # profile fetches per minute
 LOAD_WAIT, CF_WAIT, CF_RETRY = 1, 60, 2
-RAW_FILE = Path("bnw_bar_raw.csv")
+FLUSH_EVERY = 20                          # rows buffered between CSV flushes
+BLOOM_ROWS  = 100_000                     # dedup switches to a Bloom filter
+SKETCH_ROWS = 50_000                      # --fast-percentiles sample size
+RAW_FILE  = Path("bnw_bar_raw.csv.gz")
+SEEN_FILE = Path("bnw_bar_raw.seen")      # one "name\ttest_year" line per row
 
 DRILLS = {
     "60 YD":      ("60_time", "60_pct", "60_class_pct", "60_state_pct"),
@@ -44,36 +52,97 @@ BIO_COLS = [
     "city_state", "high_school", "positions", "bat_throw",
     "height", "weight", "summer_team",
 ]
-DRILL_COLS = sum((list(vals) for vals in DRILLS.values()), [])  # flatten
+DRILL_COLS  = tuple(c for cols in DRILLS.values() for c in cols)  # flatten
+DRILL_ITEMS = [(label.replace(" ", "_"), *cols) for label, cols in DRILLS.items()]
 ALL_COLS = (
     ["grad_year", "name"] +
     BIO_COLS +
     ["test_year"] +
-    DRILL_COLS +
+    list(DRILL_COLS) +
     ["profile_url", "timestamp"]
 )
 
 # ─── small helpers ────────────────────────────────────────────────────────
+_CF_RE = re.compile(r"Attention Required!|cf-error-details").search
+_YR_RE = re.compile(r"purei-bar-data-(\d{4})").search
+
+# only the profile fragments we actually read survive the parse
+_BAR_ID = re.compile(r"^player-bar-").match
+_KEEP_CLASSES = {"player-info-wrapper", "player-stats"}
+
+def _keep_profile_bits(name, attrs):
+    if _BAR_ID(attrs.get("id") or ""): return True
+    cls = attrs.get("class") or ""
+    if not isinstance(cls, str): cls = " ".join(cls)
+    return not _KEEP_CLASSES.isdisjoint(cls.split())
+
+try:                                       # bs4 >= 4.13
+    from bs4.filter import ElementFilter
+
+    class _ProfileStrainer(ElementFilter):
+        def allow_tag_creation(self, nsprefix, name, attrs):
+            return _keep_profile_bits(name, attrs or {})
+        def allow_string_creation(self, string):
+            return False                   # only consulted at top level
+
+    PROFILE_STRAINER = _ProfileStrainer()
+except ImportError:                        # bs4 <= 4.12: (name, attrs) callable
+    PROFILE_STRAINER = SoupStrainer(_keep_profile_bits)
+
+_STRIP_TBL = str.maketrans("", "", "%\xa0")
+
 tidy = lambda s: s.strip().replace("\xa0", "")
 slug_to_name = lambda s: s.replace("-", " ").title()
 grad_url = lambda y: f"{BASE}/find-player?graduation_year={y}&submit=Submit"
-looks_like_cf = lambda h: ("Attention Required!" in h) or ('cf-error-details' in h)
+looks_like_cf = lambda h: _CF_RE(h) is not None
 log = lambda m: print(time.strftime("%H:%M:%S"), m, flush=True)
 
-def to_percent(txt:str): return txt.strip().replace("%","").replace("< ","<")
+def to_percent_vec(s: pd.Series) -> pd.Series:
+    """Vectorized numeric cleaning for whole CSV columns: strips feet/inch
+    marks, and maps '<N' readings just below N so they sort correctly."""
+    s = s.astype(str).str.strip()
+    lt = s.str.startswith("<")
+    base = pd.to_numeric(s.str.lstrip("< ").str.replace("'",".").str.replace('"',""),
+                         errors="coerce")
+    return base - lt.astype(float)*0.01
+
+def seen_key(name, year):
+    """64-bit digest of a (name, test_year) pair – what the dedup set stores."""
+    return xxhash.xxh3_64_intdigest(f"{name}\x00{year}".encode())
 
-def parse_stat(div):
-    label = div.find("h4").get_text(strip=True)
-    if label not in DRILLS: return {}
-    score = tidy(div.select_one("div.stat-value").text)
-    ranks = {rp["data-type"]: to_percent(tidy(rp.text))
-             for rp in div.select("div.rank-percentile")}
-    sc, po, pc, ps = DRILLS[label]
-    return {sc:score, po:ranks.get("overall",""),
-            pc:ranks.get("graduation_year",""), ps:ranks.get("state","")}
+def make_seen(n_hint):
+    """Exact set normally; past BLOOM_ROWS entries, a scalable Bloom filter
+    (~2 B/entry vs 28 B) if pybloom_live is installed.  At 1e-4 error rate
+    a false positive – i.e. a genuinely new row skipped – is rarer than the
+    site's own data churn."""
+    if n_hint > BLOOM_ROWS:
+        try:
+            from pybloom_live import ScalableBloomFilter
+            return ScalableBloomFilter(initial_capacity=n_hint, error_rate=1e-4)
+        except ImportError:
+            log("pybloom_live not installed – keeping exact dedup set")
+    return set()
+
+def parse_stat(div, _drills=DRILLS, _tidy=tidy, _tbl=_STRIP_TBL):
+    h4 = div.find("h4")
+    if h4 is None: return {}
+    cols = _drills.get(h4.get_text(strip=True))
+    if cols is None: return {}
+    sc, po, pc, ps = cols
+    sv = div.select_one("div.stat-value")
+    out = {sc: _tidy(sv.text) if sv else "", po: "", pc: "", ps: ""}
+    for rp in div.select("div.rank-percentile"):
+        dt = rp["data-type"]
+        v = rp.text.strip().translate(_tbl).replace("< ", "<")
+        if   dt == "overall":         out[po] = v
+        elif dt == "graduation_year": out[pc] = v
+        elif dt == "state":           out[ps] = v
+    return out
 
 def parse_bio(info):
-    get = lambda sel: tidy(info.select_one(sel).text) if info.select_one(sel) else ""
+    def get(sel):
+        el = info.select_one(sel)
+        return tidy(el.text) if el else ""
     bio = {
         "positions":   get(".player-position"),
         "bat_throw":   get(".bat-throw"),
@@ -91,42 +160,50 @@ def parse_bio(info):
     return bio
 
 # ─── scrape profile ───────────────────────────────────────────────────────
+BLOCK_TYPES = {"image", "font", "media", "stylesheet"}
+
+async def block_heavy(route):
+    req = route.request
+    if req.resource_type in BLOCK_TYPES or "google-analytics" in req.url:
+        await route.abort()
+    else:
+        await route.continue_()
+
 async def fetch_html(page,url):
     url_bar=url.split("#")[0]+"#player-bar-year"
     for _ in range(CF_RETRY+1):
         await page.goto(url_bar,timeout=45_000)
+        try: await page.wait_for_selector("#player-bar-year div.stat-item",
+                                          state="attached",timeout=3000)
+        except PwTimeout: pass            # no BAR data – blank row is fine
         html=await page.content()
         if not looks_like_cf(html): return html
         log(f"   Cloudflare – wait {CF_WAIT}s"); await asyncio.sleep(CF_WAIT)
     return html
 
 async def scrape(page,url):
-    soup=BeautifulSoup(await fetch_html(page,url),"html.parser")
+    soup=BeautifulSoup(await fetch_html(page,url),"lxml",parse_only=PROFILE_STRAINER)
     if not soup.select_one("div.player-stats"): return []
 
     slug=urlparse(url).path.split("/")[-1]
     name=slug_to_name(slug)
     sel=soup.select_one("#player-bar-year select.purei-bar-filter-select")
     grad=sel.get("data_graduation_year","0000") if sel else "0000"
-    bio=parse_bio(soup.select_one("div.player-info-wrapper") or BeautifulSoup("", "html.parser"))
+    bio=parse_bio(soup.select_one("div.player-info-wrapper") or BeautifulSoup("", "lxml"))
+
+    base={"grad_year":grad,"name":name,"test_year":"",**bio,"profile_url":url,
+          "timestamp":datetime.utcnow().isoformat(timespec="seconds")}
+    for col in DRILL_COLS: base[col]=""
 
     rows=[]
     for grp in soup.select("div[id^='player-bar-'] div.stat-group"):
-        m=re.search(r"purei-bar-data-(\d{4})"," ".join(grp.get("class",[])))
+        m=_YR_RE(" ".join(grp.get("class",[])))
         if not m: continue
-        yr=m.group(1)
-        data={"grad_year":grad,"name":name,"test_year":yr}|bio
+        data=base.copy(); data["test_year"]=m.group(1)
         for it in grp.select("div.stat-item"): data.update(parse_stat(it))
-        for col in DRILL_COLS: data.setdefault(col,"")
-        data.update(profile_url=url,timestamp=datetime.utcnow().isoformat(timespec="seconds"))
         rows.append(data)
 
-    if not rows:
-        blank={"grad_year":grad,"name":name,"test_year":""}|bio
-        for col in DRILL_COLS: blank[col]=""
-        blank.update(profile_url=url,timestamp=datetime.utcnow().isoformat(timespec="seconds"))
-        rows.append(blank)
-    return rows
+    return rows or [base]
 
 # ─── collect links per year (same as before) ──────────────────────────────
 async def collect_year(page,year):
@@ -151,59 +228,116 @@ async def collect_year(page,year):
 # ─── main ─────────────────────────────────────────────────────────────────
 async def main():
     seen=set()
-    if RAW_FILE.exists():
+    if SEEN_FILE.exists():
+        lines=SEEN_FILE.read_text(encoding="utf-8").splitlines()
+        seen=make_seen(len(lines))
+        for line in lines: seen.add(seen_key(*line.split("\t",1)))
+        log(f"Loaded {len(lines):,} existing name-year pairs from sidecar.")
+    elif RAW_FILE.exists():
         try:
-            tmp=pd.read_csv(RAW_FILE,usecols=["name","test_year"])
-            seen.update(zip(tmp["name"], tmp["test_year"].fillna("")))
-            log(f"Loaded {len(seen):,} existing name-year pairs.")
+            with gzip.open(RAW_FILE,"rt",newline="",encoding="utf-8") as f:
+                pairs=[(row["name"], row.get("test_year") or "")
+                       for row in csv.DictReader(f)]
+            SEEN_FILE.write_text("".join(f"{n}\t{y}\n" for n,y in pairs),
+                                 encoding="utf-8")
+            seen=make_seen(len(pairs))
+            for n,y in pairs: seen.add(seen_key(n,y))
+            log(f"Loaded {len(pairs):,} existing name-year pairs (sidecar rebuilt).")
         except Exception as e:
             log(f"Couldn't read existing CSV ({e})")
 
     async with async_playwright() as pw:
         browser=await pw.chromium.launch(headless=True)
-        page=await browser.new_page()
+        pages=[await browser.new_page() for _ in range(POOL)]
+        for p in pages: await p.route("**/*", block_heavy)
+        page_q=asyncio.Queue()
+        for p in pages: page_q.put_nowait(p)
 
-        links=set()
-        for y in YEARS: links.update(await collect_year(page,y))
+        async def collect_with_pool(year):
+            page=await page_q.get()
+            try: return await collect_year(page,year)
+            finally: page_q.put_nowait(page)
+
+        links=set().union(*await asyncio.gather(*map(collect_with_pool,YEARS)))
         log(f"Total unique links: {len(links):,}")
 
-        ok=0
-        for idx,url in enumerate(links,1):
-            log(f"[{idx}/{len(links)}] {url}")
-            for row in await scrape(page,url):
-                key=(row["name"], str(row["test_year"]))
-                if key in seen: continue
-                seen.add(key); ok+=1
-                for col in ALL_COLS: row.setdefault(col,"")
-                first=not RAW_FILE.exists()
-                with open(RAW_FILE,"a",newline="",encoding="utf-8",buffering=1) as f:
-                    pd.DataFrame([row], columns=ALL_COLS).to_csv(f,index=False,header=first)
-                    f.flush(); os.fsync(f.fileno())
-                    if first: log(f"CSV created at {RAW_FILE.resolve()}")
-                log(f"   wrote {row['name']} ({row['test_year'] or 'no BAR'})")
-
-            # pacing
-            if ok and ok% BURST_SIZE==0:
-                log(f"   Burst {BURST_SIZE} – cooling {BURST_PAUSE}s")
-                await asyncio.sleep(BURST_PAUSE)
-            else:
-                await asyncio.sleep(random.uniform(WAIT_MIN,WAIT_MAX))
+        throttler=Throttler(rate_limit=RATE_LIMIT, period=RATE_PERIOD)
+
+        async def worker(url):
+            async with throttler:
+                page=await page_q.get()
+                try: return url,await scrape(page,url)
+                except PwError as e:
+                    log(f"   {type(e).__name__} – skipping {url}")
+                    return url,[]
+                finally: page_q.put_nowait(page)
+
+        # header goes in only if the file has no content yet – a previous
+        # zero-row run can leave an empty (but existing) gzip file behind
+        first=True
+        if RAW_FILE.exists():
+            with gzip.open(RAW_FILE,"rt",encoding="utf-8") as fh:
+                first=not fh.readline()
+        done=0; pending=[]
+        with gzip.open(RAW_FILE,"at",newline="",encoding="utf-8",
+                       compresslevel=1) as f, \
+             SEEN_FILE.open("a",encoding="utf-8") as sf:
+            writer=csv.DictWriter(f,fieldnames=ALL_COLS,extrasaction="ignore")
+
+            def flush_pending():
+                nonlocal first
+                if not pending: return
+                if first:
+                    writer.writeheader(); first=False
+                    log(f"CSV created at {RAW_FILE.resolve()}")
+                writer.writerows(pending)
+                sf.writelines(f"{r['name']}\t{r['test_year']}\n" for r in pending)
+                f.flush(); sf.flush()
+                log(f"   flushed {len(pending)} rows"); pending.clear()
+
+            try:
+                for fut in asyncio.as_completed([worker(u) for u in links]):
+                    url,rows=await fut; done+=1
+                    log(f"[{done}/{len(links)}] {url}")
+                    for row in rows:
+                        key=seen_key(row["name"], row["test_year"])
+                        if key in seen: continue
+                        seen.add(key); pending.append(row)
+                        log(f"   queued {row['name']} ({row['test_year'] or 'no BAR'})")
+                    if len(pending)>=FLUSH_EVERY: flush_pending()
+            finally:
+                flush_pending()
 
         await browser.close(); log("Browser closed.")
 
     if not RAW_FILE.exists():
         log("No rows saved."); return
 
-    # recompute percentiles
-    df=pd.read_csv(RAW_FILE)
-    idx=list(range(25,100,5))+[99]; grid={}
-    for d,(col,*_) in DRILLS.items():
-        ser=pd.to_numeric(df[col].astype(str).str.replace("'",".").str.replace('"',''),
-                          errors="coerce").dropna()
-        if not ser.empty:
-            grid[d.replace(" ","_")]=np.percentile(ser,idx).round(2)
+    # recompute percentiles – one nanpercentile pass over all drills at once
+    try:
+        df=pd.read_csv(RAW_FILE)
+    except pd.errors.EmptyDataError:      # empty gzip member from a 0-row run
+        log("No rows saved."); return
+    if df.empty:
+        log("No rows saved."); return
+    if "--fast-percentiles" in sys.argv and len(df)>SKETCH_ROWS:
+        log(f"Fast percentiles: sketching {SKETCH_ROWS:,} of {len(df):,} rows")
+        df=df.sample(n=SKETCH_ROWS,random_state=0)
+    idx=list(range(25,100,5))+[99]
+    clean=df[[item[1] for item in DRILL_ITEMS]].apply(to_percent_vec)
+    arr=clean.to_numpy(dtype=np.float64)
+    keep=~np.isnan(arr).all(axis=0)
+    pct=np.nanpercentile(arr[:,keep],idx,axis=0).round(2)
+    grid=dict(zip((item[0] for item,k in zip(DRILL_ITEMS,keep) if k), pct.T))
     pd.DataFrame(grid,index=idx).rename_axis("Percentile")\
       .to_csv("bnw_bar_percentiles.csv")
+    # cache each drill column sorted, so downstream scripts can answer
+    # "what percentile is this value?" via np.searchsorted instead of
+    # re-reading and re-sorting the raw CSV:
+    #   pct = 100 * np.searchsorted(np.load(f"bnw_bar_{col}.npy"), v) / len(...)
+    for (_,col,*_),vals in zip(DRILL_ITEMS,arr.T):
+        vals=vals[~np.isnan(vals)]
+        if vals.size: np.save(f"bnw_bar_{col}.npy",np.sort(vals))
     log("Percentiles updated")
     log("bnw_bar_percentiles.csv saved")
     log("=== Finished ===")